@@ -1,11 +1,16 @@
 import socket
+import struct
 import numpy as np
 import pandas as pd
 import pywt
+from numba import njit
 from datetime import datetime
 import threading
 import queue
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import os
+import sys
 import time
 
 # =============================================================================
@@ -18,6 +23,8 @@ class HolterConfig:
     # Red UDP
     UDP_IP = "192.168.4.101"  # IP de tu PC
     UDP_PORT = 55000
+    UDP_BATCH_MAX = 64  # datagramas leídos por lote antes de entregar a la cola
+    RING_CAPACITY = 8192  # muestras en el ring buffer receptor -> procesador (~80 s)
     
     # Frecuencia de muestreo
     SAMPLE_RATE = 100  # Hz
@@ -27,13 +34,23 @@ class HolterConfig:
     DECOMPOSITION_LEVEL = 5
     WINDOW_SIZE = 500  # muestras (5 segundos a 100Hz)
     OVERLAP = 250      # 50% overlap
+    WINDOW_LOG = float(np.log(WINDOW_SIZE))  # ln(N) del umbral universal, fijo por ventana
+    THRESHOLD_REFRESH_WINDOWS = 12  # ventanas quietas seguidas antes de recalcular el umbral MAD
+    WAVELET_WORKERS = 1  # >1: un hilo por derivación (solo compensa con ventanas largas)
     
     # Detección de movimiento
     ACC_THRESHOLD_PERCENTILE = 75
+    HIGH_MOTION_RATIO = 0.3  # fracción de muestras con movimiento para usar umbral alto
+    BYPASS_MOTION_HIGH = 0.95  # ventana saturada de artefacto: no se puede reconstruir
+    BYPASS_MOTION_LOW = 0.02   # ventana sin movimiento: no hay artefacto que reducir
     THRESHOLD_MULTIPLIER_HIGH_MOTION = 2.5
     THRESHOLD_MULTIPLIER_LOW_MOTION = 1.0
     
     # Archivos de salida
+    FILE_BUFFER_SIZE = 64 * 1024  # bytes de buffer por archivo CSV
+    WRITE_QUEUE_SIZE = 1024  # bloques pendientes para el hilo escritor
+    OFFLINE_BATCH_WINDOWS = 1024  # ventanas por lote en el reprocesamiento offline
+    RAW_FLUSH_INTERVAL = SAMPLE_RATE  # flush del CSV crudo cada ~1 s (pérdida máxima ante un fallo)
     OUTPUT_FOLDER = r'C:\Users\Lenovo\OneDrive\Desktop\PUCP\Instru\Holter_Data'
     
     @staticmethod
@@ -50,8 +67,97 @@ class HolterConfig:
 # =============================================================================
 
 def calculate_acceleration_magnitude(acc_x, acc_y, acc_z):
-    """Calcula magnitud vectorial de aceleración"""
-    return np.sqrt(acc_x**2 + acc_y**2 + acc_z**2)
+    """Calcula magnitud vectorial de aceleración (float32, operaciones in-place)"""
+    out = np.empty(np.shape(acc_x), dtype=np.float32)
+    tmp = np.empty_like(out)
+    
+    np.square(acc_x, out=out)
+    np.add(out, np.square(acc_y, out=tmp), out=out)
+    np.add(out, np.square(acc_z, out=tmp), out=out)
+    return np.sqrt(out, out=out)
+
+
+@njit(cache=True)
+def _p2_update(values, heights, positions, desired, increments, count):
+    """Actualiza los cinco marcadores P² con cada valor; devuelve el nuevo conteo"""
+    for x in values:
+        # Las primeras cinco muestras inicializan los marcadores
+        if count < 5:
+            heights[count] = x
+            count += 1
+            if count == 5:
+                heights.sort()
+            continue
+        
+        # Celda k que contiene x (ajustando los extremos)
+        if x < heights[0]:
+            heights[0] = x
+            k = 0
+        elif x >= heights[4]:
+            heights[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= heights[k + 1]:
+                k += 1
+        
+        for i in range(k + 1, 5):
+            positions[i] += 1.0
+        for i in range(5):
+            desired[i] += increments[i]
+        count += 1
+        
+        # Ajustar los marcadores centrales (parabólico, o lineal si se sale de orden)
+        for i in range(1, 4):
+            d = desired[i] - positions[i]
+            if (d >= 1.0 and positions[i + 1] - positions[i] > 1.0) or \
+                    (d <= -1.0 and positions[i - 1] - positions[i] < -1.0):
+                s = 1.0 if d > 0 else -1.0
+                h = heights[i] + s / (positions[i + 1] - positions[i - 1]) * (
+                    (positions[i] - positions[i - 1] + s) * (heights[i + 1] - heights[i])
+                    / (positions[i + 1] - positions[i])
+                    + (positions[i + 1] - positions[i] - s) * (heights[i] - heights[i - 1])
+                    / (positions[i] - positions[i - 1]))
+                if heights[i - 1] < h < heights[i + 1]:
+                    heights[i] = h
+                else:
+                    j = i + int(s)
+                    heights[i] += s * (heights[j] - heights[i]) / (positions[j] - positions[i])
+                positions[i] += s
+    return count
+
+
+class P2Quantile:
+    """
+    Estimador incremental de un cuantil con el algoritmo P² (Jain & Chlamtac, 1985).
+    Mantiene cinco marcadores: O(1) por muestra y sin guardar el historial.
+    """
+    
+    def __init__(self, q):
+        self.q = q
+        self.heights = np.zeros(5, dtype=np.float64)
+        self.positions = np.arange(1.0, 6.0)
+        self.desired = np.array([1.0, 1.0 + 2 * q, 1.0 + 4 * q, 3.0 + 2 * q, 5.0])
+        self.increments = np.array([0.0, q / 2, q, (1.0 + q) / 2, 1.0])
+        self.count = 0
+    
+    def update(self, values):
+        """Incorpora un bloque de muestras"""
+        # Contiguo siempre: una columna con stride (chunk[:, 7]) compilaría otra firma
+        self.count = _p2_update(np.ascontiguousarray(values, dtype=np.float64), self.heights,
+                                self.positions, self.desired, self.increments, self.count)
+    
+    def value(self):
+        """Cuantil estimado (None si aún no hay muestras)"""
+        if self.count == 0:
+            return None
+        if self.count < 5:
+            return float(np.percentile(self.heights[:self.count], self.q * 100))
+        return float(self.heights[2])
+
+
+# Compilar al importar para que la primera ventana no pague la compilación JIT
+P2Quantile(0.5).update(np.zeros(6))
 
 
 def detect_motion_segments(acc_magnitude, threshold):
@@ -59,61 +165,347 @@ def detect_motion_segments(acc_magnitude, threshold):
     return acc_magnitude > threshold
 
 
-def apply_wavelet_thresholding(coeffs, threshold_value, mode='soft'):
-    """Aplica umbral a coeficientes wavelet"""
-    return pywt.threshold(coeffs, threshold_value, mode=mode)
+@njit(cache=True, fastmath=True, nogil=True)
+def _soft_threshold_levels(flat, offsets, thresholds):
+    """
+    Umbral suave in-place sobre los detalles concatenados.
+    flat = (canales, M), thresholds = (canales, niveles)
+    """
+    for ch in range(flat.shape[0]):
+        for lvl in range(len(offsets) - 1):
+            t = thresholds[ch, lvl]
+            for i in range(offsets[lvl], offsets[lvl + 1]):
+                v = flat[ch, i]
+                if abs(v) <= t:
+                    flat[ch, i] = 0.0
+                elif v > 0:
+                    flat[ch, i] = v - t
+                else:
+                    flat[ch, i] = v + t
+
 
+# Compilar al importar para que la primera ventana no pague la compilación JIT
+_soft_threshold_levels(np.zeros((1, 2), dtype=np.float32),
+                       np.array([0, 1, 2], dtype=np.int64),
+                       np.ones((1, 2), dtype=np.float32))
 
-def adaptive_wavelet_filter(ecg_signal, motion_mask, wavelet='db4', level=5):
+# Wavelet construida una sola vez (evita resolver el nombre en cada wavedec/waverec)
+_WAVELET = pywt.Wavelet(HolterConfig.WAVELET_TYPE)
+
+# Factor por nivel (del detalle más grueso al más fino): 1.5^L ... 1.5^1
+_LEVEL_FACTORS = 1.5 ** np.arange(HolterConfig.DECOMPOSITION_LEVEL, 0, -1, dtype=np.float32)
+
+# Banco de filtros de _WAVELET como constantes float32 (Numba las congela al compilar)
+_DEC_LO, _DEC_HI, _REC_LO, _REC_HI = [np.asarray(f, dtype=np.float32) for f in _WAVELET.filter_bank]
+
+
+@njit(cache=True, fastmath=True, nogil=True)
+def _dwt_symmetric(x):
+    """Un nivel de DWT con _WAVELET en modo 'symmetric' (igual que pywt.dwt) sobre (canales, N)"""
+    n_ch, n = x.shape
+    f = _DEC_LO.size
+    m = (n + f - 1) // 2
+    xe = np.empty(n + 2 * (f - 1), dtype=x.dtype)
+    ca = np.empty((n_ch, m), dtype=x.dtype)
+    cd = np.empty((n_ch, m), dtype=x.dtype)
+    
+    for ch in range(n_ch):
+        # Extensión simétrica de f-1 muestras a cada lado
+        for i in range(xe.size):
+            idx = i - (f - 1)
+            while idx < 0 or idx >= n:
+                idx = -idx - 1 if idx < 0 else 2 * n - 1 - idx
+            xe[i] = x[ch, idx]
+        
+        # Convolución con los filtros de análisis y submuestreo por 2
+        for o in range(m):
+            base = 2 * o + f
+            acc_a = 0.0
+            acc_d = 0.0
+            for j in range(f):
+                v = xe[base - j]
+                acc_a += _DEC_LO[j] * v
+                acc_d += _DEC_HI[j] * v
+            ca[ch, o] = acc_a
+            cd[ch, o] = acc_d
+    return ca, cd
+
+
+@njit(cache=True, fastmath=True, nogil=True)
+def _idwt_symmetric(ca, cd):
+    """Un nivel de IDWT con _WAVELET en modo 'symmetric' (igual que pywt.idwt) sobre (canales, N)"""
+    n_ch, n = ca.shape
+    f = _REC_LO.size
+    out_len = 2 * n - f + 2
+    x = np.empty((n_ch, out_len), dtype=ca.dtype)
+    
+    for ch in range(n_ch):
+        # Sobremuestreo por 2 y convolución con los filtros de síntesis (parte válida)
+        for i in range(out_len):
+            p = i + f - 2
+            acc = 0.0
+            for j in range(p % 2, f, 2):
+                k = (p - j) // 2
+                if 0 <= k < n:
+                    acc += ca[ch, k] * _REC_LO[j] + cd[ch, k] * _REC_HI[j]
+            x[ch, i] = acc
+    return x
+
+
+def _wavedec_fast(x, level):
+    """Equivalente a pywt.wavedec(x, _WAVELET, level=level, axis=-1) para x = (canales, N)"""
+    coeffs = []
+    a = np.ascontiguousarray(x)
+    for _ in range(level):
+        a, d = _dwt_symmetric(a)
+        coeffs.append(d)
+    coeffs.append(a)
+    return coeffs[::-1]
+
+
+def _waverec_fast(coeffs):
+    """Equivalente a pywt.waverec(coeffs, _WAVELET, axis=-1) para coeficientes (canales, M)"""
+    a = coeffs[0]
+    for d in coeffs[1:]:
+        # Igual que pywt: descartar la muestra extra de la aproximación
+        if a.shape[-1] == d.shape[-1] + 1:
+            a = a[:, :-1]
+        a = _idwt_symmetric(np.ascontiguousarray(a), np.ascontiguousarray(d))
+    return a
+
+
+def adaptive_wavelet_filter(ecg_signals, motion_mask, wavelet=_WAVELET, level=5, thresholds=None):
     """
     Aplica filtrado wavelet adaptativo basado en detección de movimiento.
     Versión optimizada para procesamiento en tiempo real.
+    ecg_signals = (canales, N): todas las derivaciones se procesan en una sola llamada
+                  (también (N,) para una sola derivación)
+    motion_mask = (N,) común a todos los canales o (canales, N) con una máscara por fila
+    thresholds = (canales, niveles) de una ventana previa para omitir el cálculo MAD
+    Devuelve (señales filtradas, umbrales usados) con la misma forma que la entrada
     """
     
-    # Descomposición wavelet
-    coeffs = pywt.wavedec(ecg_signal, wavelet, level=level)
+    input_shape = np.shape(ecg_signals)
+    n_samples = input_shape[-1]
     
-    # Calcular umbral base usando MAD
-    sigma = np.median(np.abs(coeffs[-1])) / 0.6745
-    threshold_base = sigma * np.sqrt(2 * np.log(len(ecg_signal)))
+    # Los kernels trabajan sobre filas (canales, N): una derivación 1-D es una fila
+    ecg_signals = np.asarray(ecg_signals).reshape(-1, n_samples)
+    motion_mask = np.asarray(motion_mask)
+    if motion_mask.ndim > 1:
+        motion_mask = motion_mask.reshape(-1, n_samples)
+    if thresholds is not None:
+        thresholds = np.asarray(thresholds).reshape(len(ecg_signals), -1)
     
-    # Procesar coeficientes
-    coeffs_filtered = [coeffs[0]]  # Mantener aproximación
+    # Descomposición wavelet multicanal en float32 (pywt conserva el dtype);
+    # con la wavelet por defecto se usan los kernels Numba especializados
+    ecg_signals = ecg_signals.astype(np.float32, copy=False)
+    fast_path = wavelet is _WAVELET
+    if fast_path:
+        coeffs = _wavedec_fast(ecg_signals, level)
+    else:
+        coeffs = pywt.wavedec(ecg_signals, wavelet, level=level, axis=-1)
+    n_details = len(coeffs) - 1
     
-    for i in range(1, len(coeffs)):
-        detail_coeffs = coeffs[i]
-        level_factor = 1.5 ** (len(coeffs) - i)
-        
-        # Umbral adaptativo según movimiento
-        if np.mean(motion_mask) > 0.3:
-            threshold = threshold_base * HolterConfig.THRESHOLD_MULTIPLIER_HIGH_MOTION * level_factor
+    if thresholds is None:
+        # Calcular umbral base usando MAD (uno por canal); np.partition es O(N)
+        abs_c = np.abs(coeffs[-1])
+        k = abs_c.shape[-1] // 2
+        sigma = np.partition(abs_c, k, axis=-1)[..., k] / 0.6745
+        if n_samples == HolterConfig.WINDOW_SIZE:
+            log_n = HolterConfig.WINDOW_LOG
         else:
-            threshold = threshold_base * HolterConfig.THRESHOLD_MULTIPLIER_LOW_MOTION * level_factor
+            log_n = np.log(n_samples)
+        threshold_base = sigma * np.float32(np.sqrt(2 * log_n))
         
-        detail_filtered = apply_wavelet_thresholding(detail_coeffs, threshold, mode='soft')
-        coeffs_filtered.append(detail_filtered)
+        # Umbral adaptativo según movimiento (escalar o uno por fila según la máscara)
+        multiplier = np.where(np.mean(motion_mask, axis=-1) > HolterConfig.HIGH_MOTION_RATIO,
+                              np.float32(HolterConfig.THRESHOLD_MULTIPLIER_HIGH_MOTION),
+                              np.float32(HolterConfig.THRESHOLD_MULTIPLIER_LOW_MOTION))
+        
+        # Umbral por canal y nivel: los detalles más gruesos reciben un factor mayor
+        if n_details == len(_LEVEL_FACTORS):
+            level_factors = _LEVEL_FACTORS
+        else:
+            level_factors = 1.5 ** np.arange(n_details, 0, -1, dtype=np.float32)
+        thresholds = np.outer(threshold_base * multiplier, level_factors)
+    
+    # Concatenar detalles una sola vez y umbralizar in-place (Numba)
+    details = coeffs[1:]
+    offsets = np.zeros(n_details + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([d.shape[-1] for d in details])
+    flat = np.concatenate(details, axis=-1)
+    _soft_threshold_levels(flat, offsets, thresholds)
+    
+    coeffs_filtered = [coeffs[0]] + np.split(flat, offsets[1:-1], axis=-1)
     
     # Reconstrucción
-    ecg_filtered = pywt.waverec(coeffs_filtered, wavelet)
+    if fast_path:
+        ecg_filtered = _waverec_fast(coeffs_filtered)
+    else:
+        ecg_filtered = pywt.waverec(coeffs_filtered, wavelet, axis=-1)
     
     # Ajustar longitud
-    if len(ecg_filtered) > len(ecg_signal):
-        ecg_filtered = ecg_filtered[:len(ecg_signal)]
-    elif len(ecg_filtered) < len(ecg_signal):
-        ecg_filtered = np.pad(ecg_filtered, (0, len(ecg_signal) - len(ecg_filtered)), 'edge')
+    if ecg_filtered.shape[-1] > n_samples:
+        ecg_filtered = ecg_filtered[..., :n_samples]
+    elif ecg_filtered.shape[-1] < n_samples:
+        pad = [(0, 0)] * (ecg_filtered.ndim - 1) + [(0, n_samples - ecg_filtered.shape[-1])]
+        ecg_filtered = np.pad(ecg_filtered, pad, 'edge')
+    
+    return ecg_filtered.reshape(input_shape), thresholds.reshape(input_shape[:-1] + (n_details,))
+
+
+# Compilar los kernels DWT al importar (mismas firmas que una ventana real)
+adaptive_wavelet_filter(np.zeros((3, HolterConfig.WINDOW_SIZE), dtype=np.float32),
+                        np.zeros(HolterConfig.WINDOW_SIZE, dtype=bool),
+                        level=HolterConfig.DECOMPOSITION_LEVEL)
+
+
+# =============================================================================
+# FUNCIONES DE ESCRITURA CSV
+# =============================================================================
+
+# Decimales por columna (punto fijo), según la precisión natural de cada canal:
+# timestamp entero (millis), ECG con 6 decimales y aceleración con 4, igual que el
+# firmware (el ADXL345 a ±4g resuelve ~0.08 m/s² por LSB)
+_RAW_DECIMALS = np.array([0, 6, 6, 6, 4, 4, 4, 4], dtype=np.int64)
+_FILTERED_DECIMALS = np.array([0, 6, 6, 6], dtype=np.int64)
+
+
+@njit(cache=True)
+def _format_csv_rows(rows, decimals, out):
+    """
+    Escribe rows como CSV de punto fijo en out (uint8) y devuelve los bytes escritos.
+    Valores no finitos o fuera de rango (|v| * 10^d >= 9e18) se escriben como "nan".
+    """
+    scales = np.empty(decimals.size, dtype=np.float64)
+    for c in range(decimals.size):
+        scales[c] = 10.0 ** decimals[c]
+    digits = np.empty(40, dtype=np.uint8)
+    
+    n = 0
+    for r in range(rows.shape[0]):
+        for c in range(rows.shape[1]):
+            if c > 0:
+                out[n] = 44  # ','
+                n += 1
+            
+            v = rows[r, c]
+            d = decimals[c]
+            a = abs(v) * scales[c] + 0.5
+            if not a < 9e18:  # también descarta nan
+                out[n] = 110
+                out[n + 1] = 97
+                out[n + 2] = 110
+                n += 3
+                continue
+            
+            q = np.int64(a)
+            if v < 0 and q > 0:
+                out[n] = 45  # '-'
+                n += 1
+            
+            # Dígitos en orden inverso: primero los decimales, luego la parte entera
+            k = 0
+            for i in range(d):
+                digits[k] = 48 + q % 10
+                q //= 10
+                k += 1
+            digits[k] = 48 + q % 10
+            q //= 10
+            k += 1
+            while q > 0:
+                digits[k] = 48 + q % 10
+                q //= 10
+                k += 1
+            
+            for i in range(k - 1, d - 1, -1):
+                out[n] = digits[i]
+                n += 1
+            if d > 0:
+                out[n] = 46  # '.'
+                n += 1
+                for i in range(d - 1, -1, -1):
+                    out[n] = digits[i]
+                    n += 1
+        out[n] = 10  # '\n'
+        n += 1
+    return n
+
+
+def csv_row_bound(decimals):
+    """Máximo de bytes por fila: signo + 19 dígitos enteros + '.' + decimales + separador"""
+    return int(np.sum(decimals + 22))
+
+
+# Compilar al importar para que la primera escritura no pague la compilación JIT
+_format_csv_rows(np.zeros((1, 1), dtype=np.float64), _FILTERED_DECIMALS[:1],
+                 np.empty(csv_row_bound(_FILTERED_DECIMALS[:1]), dtype=np.uint8))
+
+
+# =============================================================================
+# CLASE: RING BUFFER COMPARTIDO
+# =============================================================================
+
+class SharedRingBuffer:
+    """
+    Ring buffer preasignado (capacidad, 8) para un productor y un consumidor.
+    El productor escribe filas y publica el rango (start, end) por la cola;
+    el consumidor lee las filas y libera el espacio con release(end).
+    head/tail son contadores monotónicos que escribe un solo hilo cada uno,
+    por lo que no se necesita lock (la asignación de int es atómica bajo el GIL).
+    Las filas son float64 para conservar la resolución del timestamp.
+    """
+    
+    def __init__(self, capacity, n_cols=8):
+        self.capacity = capacity
+        self.data = np.empty((capacity, n_cols), dtype=np.float64)
+        self.head = 0  # próxima fila a escribir (solo productor)
+        self.tail = 0  # primera fila no liberada (solo consumidor)
     
-    return ecg_filtered
+    def write(self, row):
+        """Escribe una fila; devuelve False si el buffer está lleno"""
+        if self.head - self.tail >= self.capacity:
+            return False
+        self.data[self.head % self.capacity] = row
+        self.head += 1
+        return True
+    
+    def read(self, start, end):
+        """Devuelve las filas [start, end) como una o dos vistas contiguas"""
+        i = start % self.capacity
+        j = i + (end - start)
+        if j <= self.capacity:
+            return [self.data[i:j]]
+        return [self.data[i:], self.data[:j - self.capacity]]
+    
+    def release(self, end):
+        """Libera las filas hasta end (exclusivo)"""
+        self.tail = end
 
 
 # =============================================================================
 # CLASE: RECEPTOR UDP
 # =============================================================================
 
+# Paquete binario: timestamp (double) + ECG_I, ECG_II, ECG_III, AccX, AccY, AccZ, AccMag (float32)
+_STRUCT = struct.Struct('<dfffffff')
+
+
 class UDPReceiver:
-    """Receptor UDP que captura datos en tiempo real"""
+    """
+    Receptor UDP que captura datos en tiempo real.
+    Acepta paquetes binarios empaquetados según _STRUCT (36 bytes, little-endian)
+    o texto "timestamp,ECG_I,ECG_II,ECG_III,AccX,AccY,AccZ,AccMag". El formato
+    binario requiere que el firmware del ESP32 envíe el struct empaquetado en
+    lugar de la línea de texto; mientras tanto se usa el parser de texto.
+    Las muestras se escriben en el ring compartido y solo se publica el rango
+    (start, end) de cada lote en batch_ranges, avisando con data_ready.
+    """
     
-    def __init__(self, data_queue):
-        self.data_queue = data_queue
+    def __init__(self, batch_ranges, data_ready, ring):
+        self.batch_ranges = batch_ranges
+        self.data_ready = data_ready
+        self.ring = ring
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.bind((HolterConfig.UDP_IP, HolterConfig.UDP_PORT))
         self.sock.settimeout(1.0)
@@ -127,30 +519,71 @@ class UDPReceiver:
         print(f"[UDP] Escuchando en {HolterConfig.UDP_IP}:{HolterConfig.UDP_PORT}")
     
     def _receive_loop(self):
-        """Loop principal de recepción"""
+        """Loop principal de recepción: bloquea por un datagrama y luego drena el resto en lote"""
         while self.running:
             try:
                 data, addr = self.sock.recvfrom(1024)
-                message = data.decode('utf-8').strip()
+                start = self.ring.head
+                self._parse_packet(data)
                 
-                # Ignorar mensajes de sistema
-                if message.startswith("ERROR") or message.startswith("SYSTEM"):
-                    print(f"[SYSTEM] {message}")
-                    continue
+                for data in self._drain_socket():
+                    self._parse_packet(data)
                 
-                # Parsear datos: timestamp,ECG_I,ECG_II,ECG_III,AccX,AccY,AccZ,AccMag
-                try:
-                    values = [float(x) for x in message.split(',')]
-                    if len(values) == 8:
-                        self.data_queue.put(values)
-                except ValueError:
-                    print(f"[WARNING] Datos inválidos recibidos: {message}")
+                # Una sola publicación por lote (deque.append es atómico bajo el GIL)
+                end = self.ring.head
+                if end > start:
+                    self.batch_ranges.append((start, end))
+                    self.data_ready.set()
                     
             except socket.timeout:
                 continue
             except Exception as e:
                 print(f"[ERROR] Error en recepción: {e}")
     
+    def _drain_socket(self):
+        """Lee sin bloquear los datagramas ya encolados en el socket (hasta UDP_BATCH_MAX)"""
+        packets = []
+        
+        # Con timeout activo Python espera aunque se use MSG_DONTWAIT,
+        # así que se pasa el socket a no bloqueante solo mientras se drena
+        self.sock.setblocking(False)
+        try:
+            while len(packets) < HolterConfig.UDP_BATCH_MAX - 1:
+                try:
+                    data, addr = self.sock.recvfrom(1024)
+                except BlockingIOError:
+                    break
+                packets.append(data)
+        finally:
+            self.sock.settimeout(1.0)
+        return packets
+    
+    def _parse_packet(self, data):
+        """Parsea un datagrama y escribe la muestra en el ring si es válida"""
+        
+        # Paquete binario (las líneas de texto siempre terminan en salto de línea)
+        if len(data) == _STRUCT.size and not data.endswith(b'\n'):
+            self._store(_STRUCT.unpack_from(data))
+            return
+        
+        # Ignorar mensajes de sistema
+        if data.startswith(b"ERROR") or data.startswith(b"SYSTEM"):
+            print(f"[SYSTEM] {data.decode('utf-8', 'replace').strip()}")
+            return
+        
+        # Parsear datos: timestamp,ECG_I,ECG_II,ECG_III,AccX,AccY,AccZ,AccMag
+        try:
+            values = np.fromstring(data, sep=',')
+            if len(values) == 8:
+                self._store(values)
+        except ValueError:
+            print(f"[WARNING] Datos inválidos recibidos: {data.decode('utf-8', 'replace').strip()}")
+    
+    def _store(self, values):
+        """Escribe la muestra en el ring; si el procesador no da abasto se descarta"""
+        if not self.ring.write(values):
+            print("[WARNING] Ring buffer lleno, muestra descartada")
+    
     def stop(self):
         """Detiene la recepción"""
         self.running = False
@@ -167,21 +600,30 @@ class WaveletProcessor:
     def __init__(self, session_folder):
         self.session_folder = session_folder
         
-        # Buffers circulares
-        self.buffer_size = HolterConfig.WINDOW_SIZE + HolterConfig.OVERLAP
-        self.ecg_I_buffer = []
-        self.ecg_II_buffer = []
-        self.ecg_III_buffer = []
-        self.acc_mag_buffer = []
-        self.timestamp_buffer = []
+        # Buffer de ventana preasignado (SoA): filas ECG_I, ECG_II, ECG_III, AccMag.
+        # Los timestamps van aparte en float64: millis() supera 2^24 ms a las ~4.6 h
+        # y en float32 perderían resolución de milisegundo.
+        self.timestamps = np.empty(HolterConfig.WINDOW_SIZE, dtype=np.float64)
+        self.buf = np.empty((4, HolterConfig.WINDOW_SIZE), dtype=np.float32)
+        self.write_idx = 0
         
-        # Variables para guardar
-        self.raw_data_list = []
-        self.filtered_data_list = []
+        # Buffer de texto reutilizable para el formateo CSV
+        self.csv_out = np.empty(HolterConfig.WINDOW_SIZE * csv_row_bound(_RAW_DECIMALS), dtype=np.uint8)
         
-        # Umbral de movimiento (se calcula adaptativamente)
+        # Umbral de movimiento: percentil de AccMag estimado en línea (P²)
+        self.acc_quantile = P2Quantile(HolterConfig.ACC_THRESHOLD_PERCENTILE / 100)
         self.acc_threshold = None
         
+        # Umbrales wavelet de la última ventana quieta (se reutilizan mientras siga quieta)
+        self.last_thresholds = None
+        self.reused_windows = 0
+        
+        # Hilos para filtrar cada derivación en paralelo (los kernels Numba y pywt liberan el GIL)
+        if HolterConfig.WAVELET_WORKERS > 1:
+            self.executor = ThreadPoolExecutor(max_workers=HolterConfig.WAVELET_WORKERS)
+        else:
+            self.executor = None
+        
         # Archivos CSV
         self.raw_csv_path = os.path.join(session_folder, "raw_data.csv")
         self.filtered_csv_path = os.path.join(session_folder, "filtered_data.csv")
@@ -194,90 +636,171 @@ class WaveletProcessor:
         raw_header = "timestamp,ECG_I,ECG_II,ECG_III,AccX,AccY,AccZ,AccMag\n"
         filtered_header = "timestamp,ECG_I_filt,ECG_II_filt,ECG_III_filt\n"
         
-        with open(self.raw_csv_path, 'w') as f:
-            f.write(raw_header)
+        # Archivos abiertos durante toda la sesión con buffer grande
+        self.raw_file = open(self.raw_csv_path, 'wb', buffering=HolterConfig.FILE_BUFFER_SIZE)
+        self.filtered_file = open(self.filtered_csv_path, 'wb', buffering=HolterConfig.FILE_BUFFER_SIZE)
         
-        with open(self.filtered_csv_path, 'w') as f:
-            f.write(filtered_header)
+        self.raw_file.write(raw_header.encode())
+        self.filtered_file.write(filtered_header.encode())
+        
+        # Hilo escritor: el disco (SD/OneDrive) no bloquea el procesamiento
+        self.write_queue = queue.Queue(maxsize=HolterConfig.WRITE_QUEUE_SIZE)
+        self.writer_thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self.writer_thread.start()
         
         print(f"[SAVE] Archivos inicializados:")
         print(f"  - {self.raw_csv_path}")
         print(f"  - {self.filtered_csv_path}")
     
-    def process_sample(self, data):
+    def process_block(self, rows):
         """
-        Procesa una muestra individual.
-        data = [timestamp, ECG_I, ECG_II, ECG_III, AccX, AccY, AccZ, AccMag]
+        Procesa un bloque de muestras contiguas.
+        rows = (n, 8): [timestamp, ECG_I, ECG_II, ECG_III, AccX, AccY, AccZ, AccMag]
+        Los datos crudos se guardan aparte con save_raw_block desde el mismo ring.
         """
         
-        # Guardar datos crudos INMEDIATAMENTE
-        self._save_raw_sample(data)
-        
-        # Agregar a buffers
-        timestamp, ecg_I, ecg_II, ecg_III, acc_x, acc_y, acc_z, acc_mag = data
+        # Copiar el bloque al buffer de ventana, partiendo en los límites de ventana
+        pos = 0
+        while pos < len(rows):
+            n = min(len(rows) - pos, HolterConfig.WINDOW_SIZE - self.write_idx)
+            chunk = rows[pos:pos + n]
+            w = self.write_idx
+            
+            self.timestamps[w:w + n] = chunk[:, 0]
+            self.buf[:3, w:w + n] = chunk[:, 1:4].T
+            self.buf[3, w:w + n] = chunk[:, 7]
+            self.acc_quantile.update(chunk[:, 7])
+            self.write_idx += n
+            pos += n
+            
+            # Si buffer está lleno, procesar
+            if self.write_idx >= HolterConfig.WINDOW_SIZE:
+                self._process_window(self.timestamps, self.buf)
+                
+                # Deslizar ventana (mantener overlap) con una sola copia vectorizada
+                self.timestamps[:HolterConfig.OVERLAP] = self.timestamps[-HolterConfig.OVERLAP:]
+                self.buf[:, :HolterConfig.OVERLAP] = self.buf[:, -HolterConfig.OVERLAP:]
+                self.write_idx = HolterConfig.OVERLAP
+    
+    def save_raw_block(self, rows):
+        """Envía al hilo escritor un bloque de filas crudas leído directamente del ring"""
+        payload = self._format_rows(rows, _RAW_DECIMALS)
         
-        self.timestamp_buffer.append(timestamp)
-        self.ecg_I_buffer.append(ecg_I)
-        self.ecg_II_buffer.append(ecg_II)
-        self.ecg_III_buffer.append(ecg_III)
-        self.acc_mag_buffer.append(acc_mag)
+        # Los datos crudos son el respaldo: esperar espacio antes de descartarlos
+        try:
+            self.write_queue.put(('raw', payload), timeout=1.0)
+        except queue.Full:
+            print(f"[WARNING] Cola de escritura llena, {len(rows)} muestras crudas descartadas")
+    
+    def _format_rows(self, rows, decimals):
+        """Formatea rows como CSV con el kernel Numba y devuelve los bytes"""
+        rows = np.ascontiguousarray(rows, dtype=np.float64)
+        needed = len(rows) * csv_row_bound(decimals)
+        if self.csv_out.size < needed:
+            self.csv_out = np.empty(needed, dtype=np.uint8)
         
-        # Si buffer está lleno, procesar
-        if len(self.ecg_I_buffer) >= HolterConfig.WINDOW_SIZE:
-            self._process_window()
+        n = _format_csv_rows(rows, decimals, self.csv_out)
+        return self.csv_out[:n].tobytes()
+    
+    def _writer_loop(self):
+        """Hilo escritor: una escritura y un flush por bloque sobre los archivos persistentes"""
+        files = {'raw': self.raw_file, 'filtered': self.filtered_file}
+        while True:
+            item = self.write_queue.get()
+            if item is None:
+                break
             
-            # Deslizar ventana (mantener overlap)
-            self.timestamp_buffer = self.timestamp_buffer[-HolterConfig.OVERLAP:]
-            self.ecg_I_buffer = self.ecg_I_buffer[-HolterConfig.OVERLAP:]
-            self.ecg_II_buffer = self.ecg_II_buffer[-HolterConfig.OVERLAP:]
-            self.ecg_III_buffer = self.ecg_III_buffer[-HolterConfig.OVERLAP:]
-            self.acc_mag_buffer = self.acc_mag_buffer[-HolterConfig.OVERLAP:]
-    
-    def _save_raw_sample(self, data):
-        """Guarda muestra cruda inmediatamente en CSV"""
-        line = ",".join([str(x) for x in data]) + "\n"
-        with open(self.raw_csv_path, 'a') as f:
-            f.write(line)
-    
-    def _process_window(self):
-        """Procesa ventana completa con wavelets"""
-        
-        # Convertir a arrays numpy
-        timestamps = np.array(self.timestamp_buffer)
-        ecg_I = np.array(self.ecg_I_buffer)
-        ecg_II = np.array(self.ecg_II_buffer)
-        ecg_III = np.array(self.ecg_III_buffer)
-        acc_mag = np.array(self.acc_mag_buffer)
-        
-        # Calcular umbral de movimiento adaptativamente
-        if self.acc_threshold is None:
-            self.acc_threshold = np.percentile(acc_mag, HolterConfig.ACC_THRESHOLD_PERCENTILE)
+            kind, payload = item
+            try:
+                files[kind].write(payload)
+                files[kind].flush()
+            except OSError as e:
+                print(f"[ERROR] Error escribiendo {kind}: {e}")
+    
+    def _process_window(self, timestamps, window):
+        """
+        Procesa ventana completa con wavelets.
+        window = buffer SoA (4, WINDOW_SIZE): ECG_I, ECG_II, ECG_III, AccMag
+        """
+        
+        acc_mag = window[3]
+        
+        # Umbral de movimiento adaptativo (percentil de toda la sesión hasta ahora)
+        self.acc_threshold = self.acc_quantile.value()
         
         # Detectar movimiento
         motion_mask = detect_motion_segments(acc_mag, self.acc_threshold)
         
-        # Aplicar filtrado wavelet a cada derivación
-        ecg_I_filt = adaptive_wavelet_filter(ecg_I, motion_mask, 
-                                             HolterConfig.WAVELET_TYPE, 
-                                             HolterConfig.DECOMPOSITION_LEVEL)
-        
-        ecg_II_filt = adaptive_wavelet_filter(ecg_II, motion_mask,
-                                              HolterConfig.WAVELET_TYPE,
-                                              HolterConfig.DECOMPOSITION_LEVEL)
+        motion_ratio = np.mean(motion_mask)
         
-        ecg_III_filt = adaptive_wavelet_filter(ecg_III, motion_mask,
-                                               HolterConfig.WAVELET_TYPE,
-                                               HolterConfig.DECOMPOSITION_LEVEL)
+        if motion_ratio > HolterConfig.BYPASS_MOTION_HIGH or motion_ratio < HolterConfig.BYPASS_MOTION_LOW:
+            # Ventana saturada o sin movimiento: se omite la DWT y se guarda la señal cruda
+            ecg_I_filt, ecg_II_filt, ecg_III_filt = window[:3]
+            status = "sin filtrar"
+        else:
+            ecg_I_filt, ecg_II_filt, ecg_III_filt = self._filter_window(window, motion_mask, motion_ratio)
+            status = "procesada"
         
         # Guardar solo las nuevas muestras (no overlap)
         n_new_samples = len(timestamps) - HolterConfig.OVERLAP
         
-        for i in range(n_new_samples):
-            filtered_line = f"{timestamps[i]},{ecg_I_filt[i]},{ecg_II_filt[i]},{ecg_III_filt[i]}\n"
-            with open(self.filtered_csv_path, 'a') as f:
-                f.write(filtered_line)
+        block = np.column_stack([timestamps[:n_new_samples],
+                                 ecg_I_filt[:n_new_samples],
+                                 ecg_II_filt[:n_new_samples],
+                                 ecg_III_filt[:n_new_samples]])
+        # Las filas filtradas se descartan primero si el disco no da abasto
+        try:
+            self.write_queue.put_nowait(('filtered', self._format_rows(block, _FILTERED_DECIMALS)))
+        except queue.Full:
+            print("[WARNING] Cola de escritura llena, ventana filtrada descartada")
+        
+        print(f"[WAVELET] Ventana {status} | Movimiento: {motion_ratio*100:.1f}% | Muestras: {len(timestamps)}")
+    
+    def _filter_window(self, window, motion_mask, motion_ratio):
+        """Filtra las tres derivaciones, reutilizando umbrales si la ventana previa fue quieta"""
         
-        print(f"[WAVELET] Ventana procesada | Movimiento: {np.mean(motion_mask)*100:.1f}% | Muestras: {len(timestamps)}")
+        low_motion = motion_ratio <= HolterConfig.HIGH_MOTION_RATIO
+        if low_motion and self.last_thresholds is not None \
+                and self.reused_windows < HolterConfig.THRESHOLD_REFRESH_WINDOWS:
+            thresholds = self.last_thresholds
+            self.reused_windows += 1
+        else:
+            thresholds = None
+            self.reused_windows = 0
+        
+        if self.executor is None:
+            # Aplicar filtrado wavelet a las tres derivaciones en una sola llamada
+            filt, thresholds = adaptive_wavelet_filter(
+                window[:3], motion_mask,
+                _WAVELET,
+                HolterConfig.DECOMPOSITION_LEVEL,
+                thresholds)
+        else:
+            # Una tarea por derivación
+            futures = [self.executor.submit(
+                adaptive_wavelet_filter,
+                window[ch:ch + 1], motion_mask,
+                _WAVELET,
+                HolterConfig.DECOMPOSITION_LEVEL,
+                None if thresholds is None else thresholds[ch:ch + 1])
+                for ch in range(3)]
+            results = [f.result() for f in futures]
+            filt = np.concatenate([r[0] for r in results])
+            thresholds = np.concatenate([r[1] for r in results])
+        self.last_thresholds = thresholds if low_motion else None
+        return filt
+    
+    def stop(self):
+        """Escribe los datos pendientes y cierra los archivos"""
+        if self.executor is not None:
+            self.executor.shutdown()
+        
+        # Vaciar la cola de escritura antes de cerrar
+        self.write_queue.put(None)
+        self.writer_thread.join()
+        for f in (self.raw_file, self.filtered_file):
+            f.flush()
+            f.close()
 
 
 # =============================================================================
@@ -289,12 +812,20 @@ class HolterSystem:
     
     def __init__(self):
         self.session_folder = HolterConfig.create_session_folder()
-        self.data_queue = queue.Queue()
-        self.receiver = UDPReceiver(self.data_queue)
+        # Canal SPSC receptor -> procesador: deque + evento, sin lock de usuario.
+        # Cada rango tiene al menos una fila, así que nunca se supera maxlen.
+        self.ring = SharedRingBuffer(HolterConfig.RING_CAPACITY)
+        self.batch_ranges = collections.deque(maxlen=HolterConfig.RING_CAPACITY)
+        self.data_ready = threading.Event()
+        self.receiver = UDPReceiver(self.batch_ranges, self.data_ready, self.ring)
         self.processor = WaveletProcessor(self.session_folder)
         self.running = False
         self.sample_count = 0
         
+        # Filas del ring ya procesadas pero aún no guardadas en el CSV crudo
+        self.raw_start = 0
+        self.processed_end = 0
+        
     def start(self):
         """Inicia el sistema Holter"""
         print("="*70)
@@ -324,35 +855,52 @@ class HolterSystem:
         
         try:
             while self.running:
-                try:
-                    # Obtener dato de la cola (timeout 1 segundo)
-                    data = self.data_queue.get(timeout=1.0)
-                    
-                    # Procesar muestra
-                    self.processor.process_sample(data)
-                    self.sample_count += 1
-                    
-                    # Imprimir progreso cada 5 segundos
-                    current_time = time.time()
-                    if current_time - last_print_time >= 5.0:
-                        elapsed = current_time - start_time
-                        rate = self.sample_count / elapsed
-                        print(f"[STATUS] Muestras: {self.sample_count} | "
-                              f"Tiempo: {elapsed:.1f}s | "
-                              f"Tasa: {rate:.1f} Hz")
-                        last_print_time = current_time
-                    
-                except queue.Empty:
+                # Esperar aviso del receptor (timeout 1 segundo)
+                if not self.batch_ranges:
+                    self.data_ready.wait(timeout=1.0)
+                    self.data_ready.clear()
                     continue
+                
+                # Procesar todos los lotes pendientes directamente desde el ring
+                while self.batch_ranges:
+                    start, end = self.batch_ranges.popleft()
+                    for rows in self.ring.read(start, end):
+                        self.processor.process_block(rows)
+                    self.processed_end = end
+                    self.sample_count += end - start
+                
+                # Guardar datos crudos desde el mismo ring (en bloques de ~1 s)
+                if self.processed_end - self.raw_start >= HolterConfig.RAW_FLUSH_INTERVAL:
+                    self._save_raw()
+                
+                # Imprimir progreso cada 5 segundos
+                current_time = time.time()
+                if current_time - last_print_time >= 5.0:
+                    elapsed = current_time - start_time
+                    rate = self.sample_count / elapsed
+                    print(f"[STATUS] Muestras: {self.sample_count} | "
+                          f"Tiempo: {elapsed:.1f}s | "
+                          f"Tasa: {rate:.1f} Hz")
+                    last_print_time = current_time
                     
         except KeyboardInterrupt:
             print("\n[HOLTER] Deteniendo sistema...")
             self.stop()
     
+    def _save_raw(self):
+        """Guarda en el CSV crudo las filas ya procesadas y libera el ring hasta ahí"""
+        end = self.processed_end
+        for rows in self.ring.read(self.raw_start, end):
+            self.processor.save_raw_block(rows)
+        self.ring.release(end)
+        self.raw_start = end
+    
     def stop(self):
         """Detiene el sistema Holter"""
         self.running = False
         self.receiver.stop()
+        self._save_raw()
+        self.processor.stop()
         
         print("\n" + "="*70)
         print("SISTEMA HOLTER - FINALIZADO")
@@ -365,10 +913,100 @@ class HolterSystem:
         print("="*70)
 
 
+# =============================================================================
+# PROCESAMIENTO OFFLINE
+# =============================================================================
+
+def process_file(raw_csv_path, filtered_csv_path=None):
+    """
+    Reprocesa un raw_data.csv de una sesión procesando todas las ventanas y
+    derivaciones en lote (OFFLINE_BATCH_WINDOWS ventanas por llamada al filtro).
+    Usa las mismas ventanas, umbral P² y bypass por movimiento que el modo en
+    tiempo real, pero sin reutilizar umbrales MAD entre ventanas quietas.
+    
+    El CSV se lee por bloques y entre bloques solo se arrastran las muestras de
+    la siguiente ventana aún incompleta, así que la memoria no crece con la
+    duración de la sesión. Con menos de WINDOW_SIZE muestras solo se escribe
+    la cabecera.
+    """
+    if filtered_csv_path is None:
+        filtered_csv_path = os.path.join(os.path.dirname(raw_csv_path), "filtered_offline.csv")
+    
+    window_size = HolterConfig.WINDOW_SIZE
+    step = HolterConfig.WINDOW_SIZE - HolterConfig.OVERLAP
+    acc_quantile = P2Quantile(HolterConfig.ACC_THRESHOLD_PERCENTILE / 100)
+    acc_fed = 0      # muestras de AccMag de `pending` ya incorporadas al estimador
+    pending = None   # muestras leídas que aún no se han escrito
+    n_windows = 0
+    
+    with open(filtered_csv_path, 'wb', buffering=HolterConfig.FILE_BUFFER_SIZE) as f:
+        f.write(b"timestamp,ECG_I_filt,ECG_II_filt,ECG_III_filt\n")
+        
+        reader = pd.read_csv(raw_csv_path, chunksize=HolterConfig.OFFLINE_BATCH_WINDOWS * step)
+        for chunk in reader:
+            data = chunk.to_numpy(dtype=np.float64)
+            if pending is not None:
+                data = np.concatenate((pending, data))
+            
+            # Aún no hay una ventana completa (archivo corto): seguir acumulando
+            if len(data) < window_size:
+                pending = data
+                continue
+            n_batch = (len(data) - window_size) // step + 1
+            
+            # Umbral de movimiento tal como lo vería el modo en tiempo real en cada ventana
+            acc_mag = data[:, 7]
+            acc_thresholds = np.empty(n_batch)
+            for i in range(n_batch):
+                end = i * step + window_size
+                acc_quantile.update(acc_mag[acc_fed:end])
+                acc_thresholds[i] = acc_quantile.value()
+                acc_fed = end
+            
+            window_idx = np.arange(n_batch)[:, None] * step + np.arange(window_size)
+            motion_masks = acc_mag[window_idx] > acc_thresholds[:, None]
+            motion_ratio = motion_masks.mean(axis=1)
+            
+            # Todas las ventanas y derivaciones del lote en una sola llamada: (ventanas*3, N)
+            ecg = np.ascontiguousarray(data[window_idx, 1:4].transpose(0, 2, 1), dtype=np.float32)
+            filt, _ = adaptive_wavelet_filter(
+                ecg.reshape(n_batch * 3, window_size),
+                np.repeat(motion_masks, 3, axis=0),
+                _WAVELET,
+                HolterConfig.DECOMPOSITION_LEVEL)
+            filt = filt.reshape(n_batch, 3, window_size)
+            
+            # Ventanas saturadas o sin movimiento: señal cruda
+            bypass = (motion_ratio > HolterConfig.BYPASS_MOTION_HIGH) | \
+                     (motion_ratio < HolterConfig.BYPASS_MOTION_LOW)
+            filt[bypass] = ecg[bypass]
+            
+            # De cada ventana se guardan solo las muestras nuevas (no overlap)
+            block = np.empty((n_batch * step, 4), dtype=np.float64)
+            block[:, 0] = data[:n_batch * step, 0]
+            block[:, 1:] = filt[:, :, :step].transpose(0, 2, 1).reshape(-1, 3)
+            
+            out = np.empty(len(block) * csv_row_bound(_FILTERED_DECIMALS), dtype=np.uint8)
+            n = _format_csv_rows(block, _FILTERED_DECIMALS, out)
+            f.write(out[:n])
+            
+            # La siguiente ventana empieza en n_batch*step: se arrastra al próximo bloque
+            n_windows += n_batch
+            pending = data[n_batch * step:]
+            acc_fed -= n_batch * step
+    
+    print(f"[OFFLINE] {n_windows} ventanas procesadas -> {filtered_csv_path}")
+    return filtered_csv_path
+
+
 # =============================================================================
 # PUNTO DE ENTRADA PRINCIPAL
 # =============================================================================
 
 if __name__ == "__main__":
-    holter = HolterSystem()
-    holter.start()
\ No newline at end of file
+    if len(sys.argv) > 1:
+        # Reprocesamiento offline: python holter_hybrid_system.py raw_data.csv
+        process_file(sys.argv[1])
+    else:
+        holter = HolterSystem()
+        holter.start()
\ No newline at end of file